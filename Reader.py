@@ -1,74 +1,200 @@
 import boto3
 import fitz  # PyMuPDF
+import hashlib
+import json
+import mmap
 import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
 from pathlib import Path
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
-from contextlib import closing
-import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+
+# A run of text up to and including closing punctuation that is followed by
+# whitespace, or the trailing fragment of a page that has none. Requiring the
+# whitespace keeps emails, URLs, decimals and version numbers in one piece.
+SENTENCE_PATTERN = re.compile(r'.+?(?:[.!?]+(?=\s)|$)', re.S)
+
+# PyMuPDF's default flags for plain-text extraction. Kept explicit so any
+# change to them is deliberate - and comes with a TEXT_CACHE_VERSION bump.
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT
 
 class AWSPDFConverter:
     """
     Converts PDFs to MP3 files using AWS Polly for high-quality speech synthesis.
     Handles large documents by breaking them into manageable chunks and provides
     detailed progress tracking.
+
+    Synthesized chunks are cached under temp_audio_files/tts_cache so re-runs
+    skip Polly. The cache keeps a second copy of every converted book's audio,
+    so it is trimmed oldest-first to MAX_TTS_CACHE_BYTES after each conversion;
+    pass cache_audio=False to keep chunks in memory and write nothing to disk.
     """
-    def __init__(self, aws_access_key_id, aws_secret_access_key, region_name='us-east-1'):
+    # Number of Polly requests kept in flight at once - keep this at or below
+    # your account's SynthesizeSpeech TPS quota
+    MAX_WORKERS = 8
+
+    # Combine chunk files with ffmpeg instead of streaming MP3 frames straight
+    # into the output. Only needed if chunks can differ in sample rate or bitrate.
+    USE_FFMPEG = False
+
+    # AWS Polly has a 3000 character limit per request
+    # We'll use 2800 to leave some margin
+    MAX_CHUNK_SIZE = 2800
+
+    # Part of the text cache key - bump whenever a change to the extraction
+    # or chunking logic would produce different chunks for the same PDF
+    TEXT_CACHE_VERSION = 3
+
+    # Asynchronous synthesis tasks accept up to 100,000 billable characters,
+    # so documents need a handful of tasks instead of hundreds of requests
+    MAX_TASK_CHUNK_SIZE = 99000
+
+    # Seconds to wait between status checks on a running synthesis task
+    TASK_POLL_INTERVAL = 5
+
+    # Seconds to wait for a single synthesis task before giving up on it
+    TASK_TIMEOUT = 30 * 60
+
+    # Seconds to spend waiting for abandoned tasks to finish so their
+    # output can be removed after a failed conversion
+    TASK_CLEANUP_TIMEOUT = 5 * 60
+
+    # Upper bound on the synthesized audio cache - least recently used
+    # chunks are deleted once it grows past this
+    MAX_TTS_CACHE_BYTES = 1 << 30
+
+    def __init__(self, aws_access_key_id, aws_secret_access_key, region_name='us-east-1',
+                 output_s3_bucket=None, cache_audio=True):
+        # Adaptive retries back off on ThrottlingException instead of us
+        # sleeping a fixed amount between every request. Tight timeouts stop
+        # a stale pooled connection from stalling for the default 60s, and
+        # the pool is sized above MAX_WORKERS so threads never wait on it.
+        config = Config(
+            connect_timeout=5,
+            read_timeout=15,
+            max_pool_connections=32,
+            retries={'max_attempts': 10, 'mode': 'adaptive'}
+        )
+
         # Initialize AWS services with your credentials
         self.polly_client = boto3.client(
             'polly',
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
-            region_name=region_name
+            region_name=region_name,
+            config=config
         )
+
+        # With a bucket, Polly writes large chunks there through asynchronous
+        # synthesis tasks and we download the results
+        self.output_s3_bucket = output_s3_bucket
+        if output_s3_bucket:
+            self.s3_client = boto3.client(
+                's3',
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region_name,
+                config=config
+            )
         
         # Default voice settings - Joanna is a natural-sounding neural voice
         self.voice_id = 'Joanna'
+        self.engine = 'neural'  # Use neural engine for better quality
         self.output_format = 'mp3'
         
         # Create a directory for temporary files
         self.temp_dir = Path('temp_audio_files')
         self.temp_dir.mkdir(exist_ok=True)
 
-    def extract_text_from_pdf(self, pdf_path):
+        # Extracted text chunks and synthesized audio are cached by content
+        # hash, so re-running on an unchanged PDF skips both stages
+        self.text_cache_dir = self.temp_dir / 'cache'
+        self.text_cache_dir.mkdir(exist_ok=True)
+        self.cache_audio = cache_audio
+        self.tts_cache_dir = self.temp_dir / 'tts_cache'
+        if cache_audio:
+            self.tts_cache_dir.mkdir(exist_ok=True)
+
+    def extract_text_from_pdf(self, pdf_path, max_chunk_size=None):
         """
         Extracts text from PDF using PyMuPDF, which is faster and more reliable
         than PyPDF2. Handles complex layouts and different PDF formats.
         """
         print(f"Reading PDF: {pdf_path}")
         text_chunks = []
+        max_chunk_size = max_chunk_size or self.MAX_CHUNK_SIZE
         
         try:
-            # Open PDF document
-            doc = fitz.open(pdf_path)
-            
-            # AWS Polly has a 3000 character limit per request
-            # We'll use 2800 to leave some margin
-            MAX_CHUNK_SIZE = 2800
+            # Map the file instead of reading it, so the OS only pages in the
+            # parts of a large PDF that are actually touched
+            with self._map_file(pdf_path) as data:
+                # Reuse the chunks from a previous run on an identical file
+                cache_key = f"{hashlib.sha256(data).hexdigest()}-{max_chunk_size}-v{self.TEXT_CACHE_VERSION}"
+                cache_file = self.text_cache_dir / f"{cache_key}.json"
+                if cache_file.exists():
+                    try:
+                        text_chunks = json.loads(cache_file.read_text(encoding='utf-8'))
+                        print(f"Loaded {len(text_chunks)} text chunks from cache")
+                        return text_chunks
+                    except ValueError:
+                        # Unreadable entry - treat it as a miss and rebuild it
+                        print(f"Discarding corrupt text cache entry: {cache_file}")
+                        cache_file.unlink()
+
+                # Open PDF document
+                doc = fitz.open(stream=data, filetype='pdf')
             
-            current_chunk = ""
+                # Collect sentences in a list and track the running length, so a
+                # chunk is only joined into a string once, when it is flushed
+                current_chunk = []
+                current_length = 0
             
-            # Process each page
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                text = page.get_text()
-                
-                # Split text into sentences (rough approximation)
-                sentences = text.replace('\n', ' ').split('. ')
-                
-                for sentence in sentences:
-                    # Check if adding this sentence would exceed chunk size
-                    if len(current_chunk) + len(sentence) < MAX_CHUNK_SIZE:
-                        current_chunk += sentence + '. '
-                    else:
-                        # Store current chunk and start a new one
-                        if current_chunk:
-                            text_chunks.append(current_chunk.strip())
-                        current_chunk = sentence + '. '
+                try:
+                    # Iterate pages rather than indexing them, dropping each page
+                    # once its text is read so memory stays flat on long books
+                    for page in doc:
+                        text = page.get_text("text", flags=TEXT_FLAGS)
+                        del page
+                    
+                        # Walk the sentences (rough approximation) without building
+                        # an intermediate copy or list of the page text
+                        for match in SENTENCE_PATTERN.finditer(text):
+                            sentence = match.group().strip()
+                            if not sentence:
+                                continue
+
+                            # Check if adding this sentence would exceed chunk size
+                            if current_length + len(sentence) >= max_chunk_size and current_chunk:
+                                # Store current chunk and start a new one
+                                text_chunks.append(''.join(current_chunk).strip())
+                                current_chunk = []
+                                current_length = 0
+                            current_chunk.append(sentence + ' ')
+                            current_length += len(sentence) + 1
+                finally:
+                    doc.close()
             
             # Add the last chunk if it exists
             if current_chunk:
-                text_chunks.append(current_chunk.strip())
+                text_chunks.append(''.join(current_chunk).strip())
             
+            # Write to a unique temp file and rename it into place, so an
+            # interrupted run never leaves a truncated cache entry
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.text_cache_dir,
+                                             delete=False) as file:
+                try:
+                    json.dump(text_chunks, file)
+                except Exception:
+                    file.close()
+                    os.remove(file.name)
+                    raise
+            os.replace(file.name, cache_file)
             print(f"Extracted {len(text_chunks)} text chunks")
             return text_chunks
             
@@ -76,59 +202,284 @@ class AWSPDFConverter:
             print(f"Error extracting text from PDF: {str(e)}")
             raise
 
-    def synthesize_speech(self, text, output_path):
+    @staticmethod
+    @contextmanager
+    def _map_file(path):
+        """
+        Memory-maps a file read-only and yields a memoryview of its bytes,
+        which both hashlib and PyMuPDF accept without copying.
+        """
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as data:
+                    yield data
+
+    @staticmethod
+    @contextmanager
+    def _atomic_output(path):
+        """
+        Yields a binary file that is written next to path and only moved onto
+        it once the block completes, so a failed conversion never leaves a
+        truncated MP3 behind.
+        """
+        partial_path = f"{path}.part"
+        # Opened outside the try, so a failure to create the file surfaces
+        # as-is rather than as an error removing a file that doesn't exist
+        file = open(partial_path, 'wb')
+        try:
+            with file:
+                yield file
+        except BaseException:
+            os.remove(partial_path)
+            raise
+        os.replace(partial_path, path)
+
+    def synthesize_speech(self, text, output_file):
         """
         Converts text to speech using AWS Polly's neural engine.
-        Handles the API call and saves the audio stream to a file.
+        Handles the API call and writes the audio stream to an open
+        binary file object.
         """
         try:
             # Request speech synthesis
             response = self.polly_client.synthesize_speech(
-                Engine='neural',  # Use neural engine for better quality
+                Engine=self.engine,
                 OutputFormat=self.output_format,
                 Text=text,
                 VoiceId=self.voice_id
             )
             
-            # Save the audio stream to a file
-            if "AudioStream" in response:
-                with closing(response["AudioStream"]) as stream:
-                    with open(output_path, "wb") as file:
-                        file.write(stream.read())
+            # Without audio there is nothing to write - fail rather than
+            # let the chunk silently drop out of the book (or the cache)
+            if "AudioStream" not in response:
+                raise Exception(f"Polly returned no audio stream for text: {text[:50]!r}")
+
+            # Copy the audio stream into the output file
+            with closing(response["AudioStream"]) as stream:
+                # Write as the audio arrives so each worker only ever
+                # holds one 64 KiB block of the response in memory
+                for block in stream.iter_chunks(chunk_size=65536):
+                    output_file.write(block)
             
         except (BotoCoreError, ClientError) as error:
             print(f"Error synthesizing speech: {error}")
             raise
 
+    def start_speech_synthesis_task(self, text):
+        """
+        Starts an asynchronous Polly synthesis task that writes its audio to
+        the output S3 bucket, and returns the task ID.
+        """
+        try:
+            response = self.polly_client.start_speech_synthesis_task(
+                Engine=self.engine,
+                OutputFormat=self.output_format,
+                OutputS3BucketName=self.output_s3_bucket,
+                Text=text,
+                VoiceId=self.voice_id
+            )
+            return response['SynthesisTask']['TaskId']
+
+        except (BotoCoreError, ClientError) as error:
+            print(f"Error starting speech synthesis task: {error}")
+            raise
+
+    def download_task_audio(self, task_id, output_file, delete=True):
+        """
+        Waits for a synthesis task to finish, streams its audio from S3 into
+        an open binary file object, then deletes the S3 object unless it is
+        still needed.
+        """
+        try:
+            deadline = time.monotonic() + self.TASK_TIMEOUT
+            while True:
+                task = self.polly_client.get_speech_synthesis_task(TaskId=task_id)['SynthesisTask']
+                if task['TaskStatus'] == 'completed':
+                    break
+                if task['TaskStatus'] == 'failed':
+                    raise Exception(f"Synthesis task {task_id} failed: {task.get('TaskStatusReason')}")
+                if time.monotonic() > deadline:
+                    raise Exception(
+                        f"Synthesis task {task_id} still {task['TaskStatus']} after {self.TASK_TIMEOUT}s"
+                    )
+                time.sleep(self.TASK_POLL_INTERVAL)
+
+            # Polly names the output object after the task ID
+            key = f"{task_id}.{self.output_format}"
+            response = self.s3_client.get_object(Bucket=self.output_s3_bucket, Key=key)
+            with closing(response['Body']) as stream:
+                for block in stream.iter_chunks(chunk_size=65536):
+                    output_file.write(block)
+
+            # The audio now lives in the output file, so don't leave a copy
+            # of every chunk behind in the bucket
+            if delete:
+                self.s3_client.delete_object(Bucket=self.output_s3_bucket, Key=key)
+
+        except (BotoCoreError, ClientError) as error:
+            print(f"Error downloading speech synthesis task: {error}")
+            raise
+
+    def _remove_task_outputs(self, task_ids):
+        """
+        Best-effort removal of the S3 audio written by tasks that a failed
+        conversion abandoned. Unfinished tasks are waited on for up to
+        TASK_CLEANUP_TIMEOUT; anything that can't be removed is printed so
+        it can be cleaned up by hand.
+        """
+        deadline = time.monotonic() + self.TASK_CLEANUP_TIMEOUT
+        orphaned = []
+        for task_id in task_ids:
+            key = f"{task_id}.{self.output_format}"
+            try:
+                while True:
+                    task = self.polly_client.get_speech_synthesis_task(TaskId=task_id)['SynthesisTask']
+                    if task['TaskStatus'] not in ('scheduled', 'inProgress'):
+                        break
+                    if time.monotonic() > deadline:
+                        raise Exception(f"task still {task['TaskStatus']}")
+                    time.sleep(self.TASK_POLL_INTERVAL)
+
+                self.s3_client.delete_object(Bucket=self.output_s3_bucket, Key=key)
+            except Exception as error:
+                print(f"Could not remove output of synthesis task {task_id}: {error}")
+                orphaned.append(key)
+
+        if orphaned:
+            print(f"Left behind in s3://{self.output_s3_bucket}: {', '.join(orphaned)}")
+
+    def _cached_speech(self, text):
+        """
+        Returns the path of the synthesized audio for a chunk, only calling
+        Polly if this text, voice and engine have not been synthesized before.
+        """
+        key = hashlib.sha256(
+            f"{self.voice_id}\0{self.engine}\0{self.output_format}\0{text}".encode('utf-8')
+        ).hexdigest()
+        cache_file = self.tts_cache_dir / f"{key}.{self.output_format}"
+
+        if cache_file.exists():
+            # Mark the entry as recently used so pruning evicts it last
+            os.utime(cache_file)
+        else:
+            # Write to a unique temp file and rename it into place, so an
+            # interrupted or failed request never leaves a partial cache entry
+            with tempfile.NamedTemporaryFile(dir=self.tts_cache_dir, delete=False) as file:
+                try:
+                    self.synthesize_speech(text, file)
+                except Exception:
+                    file.close()
+                    os.remove(file.name)
+                    raise
+            os.replace(file.name, cache_file)
+
+        return cache_file
+
+    def _buffered_speech(self, text):
+        """
+        Returns the synthesized audio for a chunk in a temporary buffer, for
+        when the audio cache is disabled.
+        """
+        # Small chunks stay in memory, anything unusually large spills to disk
+        buffer = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+        try:
+            self.synthesize_speech(text, buffer)
+        except Exception:
+            buffer.close()
+            raise
+        return buffer
+
+    def _prune_tts_cache(self):
+        """
+        Deletes the least recently used audio cache entries until the cache
+        fits within MAX_TTS_CACHE_BYTES.
+        """
+        entries = sorted(
+            ((entry.stat(), entry) for entry in self.tts_cache_dir.glob(f"*.{self.output_format}")),
+            key=lambda item: item[0].st_mtime
+        )
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, entry in entries:
+            if total <= self.MAX_TTS_CACHE_BYTES:
+                break
+            entry.unlink()
+            total -= stat.st_size
+
+    def _synthesize_in_order(self, text_chunks):
+        """
+        Synthesizes chunks concurrently - Polly calls are network-bound, so
+        threads let us overlap the round trips - and yields each chunk's
+        audio as a readable file object, in document order.
+        """
+        synthesize = self._cached_speech if self.cache_audio else self._buffered_speech
+
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            # Repeated chunks (running headers, footers, boilerplate) share a
+            # single request, and their audio is re-emitted for every repeat
+            futures = {}
+            last_use = {chunk: i for i, chunk in enumerate(text_chunks)}
+            try:
+                for chunk in text_chunks:
+                    if chunk not in futures:
+                        futures[chunk] = executor.submit(synthesize, chunk)
+
+                for i, chunk in enumerate(text_chunks):
+                    # Re-raises any synthesis error from the worker thread
+                    result = futures[chunk].result()
+                    print(f"Processed chunk {i+1}/{len(text_chunks)}")
+                    if self.cache_audio:
+                        with open(result, 'rb') as buffer:
+                            yield buffer
+                    else:
+                        result.seek(0)
+                        yield result
+                        if last_use[chunk] == i:
+                            result.close()
+            except BaseException:
+                # Once a chunk fails, drop the queued requests instead of
+                # sending the rest of the document to Polly for nothing
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        if self.cache_audio:
+            self._prune_tts_cache()
+
     def combine_audio_files(self, input_files, output_file):
         """
-        Combines multiple audio chunks into a single MP3 file using ffmpeg.
-        Now with more robust path handling and error checking.
+        Combines multiple audio chunk files into a single MP3 file by
+        re-muxing them with ffmpeg's concat demuxer. Only used when
+        USE_FFMPEG is set; by default chunks are streamed straight into
+        the output file instead.
         """
         try:
             # Convert output_file to absolute path
             output_file = os.path.abspath(output_file)
-        
+
             # Create a file listing all audio chunks with absolute paths
             list_file = os.path.join(self.temp_dir, 'file_list.txt')
             print(f"Creating file list at: {list_file}")
-        
+
             with open(list_file, 'w') as f:
                 for file in input_files:
                     # Ensure we're using absolute paths
                     abs_path = os.path.abspath(file)
                     print(f"Adding file to list: {abs_path}")
                     f.write(f"file '{abs_path}'\n")
-        
-            # Construct and execute ffmpeg command
-            ffmpeg_cmd = f'ffmpeg -f concat -safe 0 -i "{list_file}" -c copy "{output_file}"'
-            print(f"Executing command: {ffmpeg_cmd}")
-        
-            # Execute ffmpeg command
-            result = os.system(ffmpeg_cmd)
-        
-            if result != 0:
-                raise Exception(f"ffmpeg command failed with exit code {result}")
+
+            try:
+                # Pass arguments as a list so paths never go through a shell.
+                # No -threads: with -c copy nothing is decoded or encoded, so
+                # there is no codec work for extra threads to share.
+                ffmpeg_cmd = [
+                    'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                    '-thread_queue_size', '1024',
+                    '-f', 'concat', '-safe', '0',
+                    '-i', list_file, '-c', 'copy', output_file
+                ]
+                print(f"Executing command: {' '.join(ffmpeg_cmd)}")
+                subprocess.run(ffmpeg_cmd, check=True)
+            finally:
+                os.remove(list_file)
             
             # Verify the output file was created
             if not os.path.exists(output_file):
@@ -137,7 +488,6 @@ class AWSPDFConverter:
             print(f"Successfully created output file at: {output_file}")
         
             # Clean up temporary files
-            os.remove(list_file)
             for file in input_files:
                 if os.path.exists(file):
                     os.remove(file)
@@ -162,25 +512,53 @@ class AWSPDFConverter:
             output_dir = os.path.dirname(output_path)
             os.makedirs(output_dir, exist_ok=True)
             
-            # Extract text chunks from PDF
-            text_chunks = self.extract_text_from_pdf(pdf_path)
-            
-            # Process each chunk
-            temp_files = []
-            for i, chunk in enumerate(text_chunks):
-                print(f"Processing chunk {i+1}/{len(text_chunks)}")
-                
-                # Create temporary file for this chunk using absolute path
-                temp_file = os.path.join(self.temp_dir, f"chunk_{i}.mp3")
-                self.synthesize_speech(chunk, temp_file)
-                temp_files.append(temp_file)
-                
-                # Small delay to avoid AWS rate limits
-                time.sleep(0.5)
-            
-            # Combine all audio chunks into final file
-            print("Combining audio chunks...")
-            self.combine_audio_files(temp_files, output_path)
+            if self.output_s3_bucket:
+                # Start every task up front so Polly works on them in
+                # parallel, then append the results in document order
+                text_chunks = self.extract_text_from_pdf(pdf_path, self.MAX_TASK_CHUNK_SIZE)
+                task_ids = {}
+                removed = set()
+                try:
+                    for chunk in text_chunks:
+                        if chunk not in task_ids:
+                            task_ids[chunk] = self.start_speech_synthesis_task(chunk)
+
+                    # Repeated chunks share one S3 object, so only delete it
+                    # after the last time it is used
+                    last_use = {chunk: i for i, chunk in enumerate(text_chunks)}
+                    with self._atomic_output(output_path) as final_file:
+                        for i, chunk in enumerate(text_chunks):
+                            delete = last_use[chunk] == i
+                            self.download_task_audio(task_ids[chunk], final_file, delete=delete)
+                            if delete:
+                                removed.add(task_ids[chunk])
+                            print(f"Processed chunk {i+1}/{len(text_chunks)}")
+                except BaseException:
+                    # Tasks that were already started keep running and write
+                    # their audio to the bucket, so clean those up too
+                    self._remove_task_outputs(
+                        [task_id for task_id in task_ids.values() if task_id not in removed]
+                    )
+                    raise
+            elif self.USE_FFMPEG:
+                # ffmpeg re-muxes from files, so write each chunk out first
+                text_chunks = self.extract_text_from_pdf(pdf_path)
+                temp_files = []
+                for i, buffer in enumerate(self._synthesize_in_order(text_chunks)):
+                    temp_file = os.path.join(self.temp_dir, f"chunk_{i}.mp3")
+                    with open(temp_file, 'wb') as file:
+                        shutil.copyfileobj(buffer, file, 65536)
+                    temp_files.append(temp_file)
+
+                print("Combining audio chunks...")
+                self.combine_audio_files(temp_files, output_path)
+            else:
+                # MP3 frames concatenate cleanly, so stream every chunk
+                # straight into the final file as it becomes available
+                text_chunks = self.extract_text_from_pdf(pdf_path)
+                with self._atomic_output(output_path) as final_file:
+                    for buffer in self._synthesize_in_order(text_chunks):
+                        shutil.copyfileobj(buffer, final_file, 65536)
             
             print(f"Conversion complete! Audio saved to: {output_path}")
             